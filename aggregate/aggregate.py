@@ -29,7 +29,8 @@ This script creates a multi-laser photonic integrated circuit layout by:
 1. LOADING SUBMISSIONS:
    - Loads all GDS/OAS files from the submissions folder
    - Categorizes designs by course (ELEC413, edXphot1x, openEBL, SiEPIC_Passives)
-   - Processes each design and creates sub-cells with proper layer filtering
+   - Processes each design in parallel worker processes (layer filtering, clipping),
+     saving it to a temporary OASIS file, which is then merged into a sub-cell
    - Handles DBU correction and scaling if needed
 
 2. POWER MONITOR INTEGRATION:
@@ -193,6 +194,11 @@ def copy_to_shuksan_designs_folder(file_path):
 layer_text = '10/0'
 layer_SEM = '200/0'
 layer_SEM_allow = ['edXphot1x', 'ELEC413','SiEPIC_Passives']  # which submission folder is allowed to include SEM images
+# course for the submission, found in the filename, in order of priority; otherwise openEBL
+courses = [('elec413', 'ELEC413'), ('ebeam', 'edXphot1x'), ('openebl', 'openEBL'), ('siepic_passives', 'SiEPIC_Passives')]
+# (layer, datatype) pairs to keep, with and without the SEM layer
+layers_keep_set = {tuple(int(n) for n in l.split('/')) for l in layers_keep}
+layers_keep_SEM_set = layers_keep_set | {tuple(int(n) for n in layer_SEM.split('/'))}
 layers_move = [[[31,0],[1,0]]] # move shapes from layer 1 to layer 2
 dbu = 0.001
 log_siepictools = True
@@ -249,16 +255,23 @@ box = Box( Point(-die_edge, -die_edge), Point(die_edge, die_edge) )
 top_cell.shapes(ly.layer(TECHNOLOGY['FloorPlan'])).insert(box)
 '''
 
+libraries_disabled = False  # set by disable_libraries(), when it removes any library
 def disable_libraries():
+    global libraries_disabled
     print('Disabling KLayout libraries')
     for l in pya.Library().library_ids():
         print(' - %s' % pya.Library().library_by_id(l).name())
         pya.Library().library_by_id(l).delete()
+        libraries_disabled = True
 def enable_libraries():
-    import siepic_ebeam_pdk
+    # Register the PDK libraries again, only if they were removed.
+    # Only the pymacros module loads the libraries; the package itself is already initialized
+    global libraries_disabled
+    if not libraries_disabled:
+        return
     from importlib import reload  
-    siepic_ebeam_pdk = reload(siepic_ebeam_pdk)
     siepic_ebeam_pdk.pymacros = reload(siepic_ebeam_pdk.pymacros)
+    libraries_disabled = False
 
 
 
@@ -266,30 +279,29 @@ def enable_libraries():
 import os
 path = os.path.dirname(os.path.realpath(__file__))
 
-# Log file
+# Log file, buffered: written to disk in a few large blocks
 global log_file
 log_file = open(os.path.join(path,filename_out+'.txt'), 'w')
 def log(text):
     global log_file
-    log_file.write(text)
-    log_file.write('\n')
+    log_file.write(text + '\n')
 
 log('SiEPIC-Tools %s, layout merge, running KLayout 0.%s.%s ' % (SiEPIC.__version__, KLAYOUT_VERSION,KLAYOUT_VERSION_3) )
 current_time = now.strftime("%Y-%m-%d, %H:%M:%S local time")
 log("Date: %s" % current_time)
 
+def layout_files(path2):
+    """List the GDS/OAS files in a folder, sorted by name."""
+    if not os.path.isdir(path2):
+        return []
+    with os.scandir(path2) as it:
+        return sorted(e.path for e in it if e.is_file() and e.name.lower().endswith(('.oas', '.gds')))
+
 # Load all the GDS/OAS files from the "submissions" folder:
-path2 = os.path.abspath(os.path.join(path,"../submissions"))
-files_in = []
-_, _, files = next(os.walk(path2), (None, None, []))
-for f in sorted(files):
-    files_in.append(os.path.join(path2,f))
+files_in = layout_files(os.path.abspath(os.path.join(path,"../submissions")))
 
 # Load all the GDS/OAS files from the "framework" folder:
-path2 = os.path.abspath(os.path.join(path,"../framework"))
-_, _, files = next(os.walk(path2), (None, None, []))
-for f in sorted(files):
-    files_in.append(os.path.join(path2,f))
+files_in += layout_files(os.path.abspath(os.path.join(path,"../framework")))
 
 # Create course cells using the folder name under the top cell
 cell_edXphot1x = layout.create_cell("edX")
@@ -301,6 +313,7 @@ cell_SiEPIC_Passives = layout.create_cell("SiEPIC_Passives")
 top_cell.insert(CellInstArray(cell_SiEPIC_Passives.cell_index(), t))
 cell_openEBL = layout.create_cell("openEBL")
 top_cell.insert(CellInstArray(cell_openEBL.cell_index(), t))
+course_cells_by_name = {'edXphot1x': cell_edXphot1x, 'ELEC413': cell_ELEC413, 'SiEPIC_Passives': cell_SiEPIC_Passives, 'openEBL': cell_openEBL}
 
 # Create a date	stamp cell, and add a text label
 merge_stamp = '.merged:'+now.strftime("%Y-%m-%d-%H:%M:%S")
@@ -312,22 +325,23 @@ top_cell.insert(CellInstArray(cell_date.cell_index(), t))
 
 # Load all the layouts, without the libraries (no PCells)
 disable_libraries()
-# Origins for the layouts
-x,y = 2.5e6,cell_Height+cell_Gap_Height
-design_count = 0
-subcell_instances = []
-course_cells = []  # list of each of the student designs
-cells_course = []  # into which course cell the design should go into
-import subprocess
-import pandas as pd
-for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
+
+def process_submission(index, f, tmp_dir):
+    '''
+    Load one submission, clean it up, and save it to a temporary OASIS file.
+    Runs in a worker process; returns the log messages, and the designs to merge
+    '''
+    messages = []
+    def log(text):
+        messages.append(text)
+
     basefilename = os.path.basename(f)
 
     # GitHub Action gets the actual time committed.  This can be done locally
     # via git restore-mtime.  Then we can load the time from the file stamp
 
-    filedate = datetime.fromtimestamp(os.path.getmtime(f)).strftime("%Y%m%d_%H%M")
-    log("\nLoading: %s, dated %s" % (os.path.basename(f), filedate))
+    filedate = time.strftime("%Y%m%d_%H%M", time.localtime(os.path.getmtime(f)))
+    log("\nLoading: %s, dated %s" % (basefilename, filedate))
 
     # Tried to get it from GitHub but that didn't work:
     # get the time the file was last updated from the Git repository 
@@ -336,22 +350,13 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
     #filedate = os.path.getctime(os.path.dirname(f)) # .strftime("%Y%m%d_%H%M")
     
   
-    # Load layout  
-    layout2 = pya.Layout()
+    # Load layout, non-editable, to reduce the memory and keep the shape arrays
+    layout2 = pya.Layout(False)
     layout2.read(f)
 
-    if 'elec413' in basefilename.lower():
-        course = 'ELEC413'
-    elif 'ebeam' in basefilename.lower():
-        course = 'edXphot1x'
-    elif 'openebl' in basefilename.lower():
-        course = 'openEBL'
-    elif 'siepic_passives' in basefilename.lower():
-        course = 'SiEPIC_Passives'
-    else:
-        course = 'openEBL'
+    name = basefilename.lower()
+    course = next((c for k, c in courses if k in name), 'openEBL')
 
-    cell_course = eval('cell_' + course)
     log("  - course name: %s" % (course) )
 
     # Check the DBU Database Unit, in case someone changed it, e.g., 5 nm, or 0.1 nm.
@@ -377,99 +382,180 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
     if num_top_cells == 0:
         log('  - layout does not contain a top cell')
 
+    # Temporary OASIS files, compressed, one per design; static cells, no PCell context
+    options = pya.SaveLayoutOptions()
+    options.format = 'OASIS'
+    options.oasis_compression_level = 10
+    options.write_context_info = False
+    designs = []
+    def save_design(cell_index):
+        tmp_file = os.path.join(tmp_dir, '%s_%s_%s.oas' % (index, basefilename, len(designs)))
+        options.clear_cells()
+        options.select_cell(cell_index)
+        layout2.write(tmp_file, options)
+        return tmp_file
+
     # Find the top cell
     for cell in layout2.top_cells():
-        if framework_file in os.path.basename(f) :
-            # Create sub-cell using the filename under top cell
-            subcell2 = layout.create_cell(os.path.basename(f)+"_"+filedate)
-            t = Trans(Trans.M90, 0,0)
-            top_cell.insert(CellInstArray(subcell2.cell_index(), t))
-            # copy
-            subcell2.copy_tree(layout2.cell(cell.name)) 
+        if framework_file in basefilename or basefilename == ubc_file:
+            designs.append({'file': save_design(cell.cell_index())})
             break
 
-        if os.path.basename(f) == ubc_file:
-            # Create sub-cell using the filename under top cell
-            subcell2 = layout.create_cell(os.path.basename(f)+"_"+filedate)
-            t = Trans(Trans.R0, 8780000,8780000)      
-            top_cell.insert(CellInstArray(subcell2.cell_index(), t))
-            # copy
-            subcell2.copy_tree(layout2.cell(cell.name)) 
-            break
-
-
         if num_top_cells == 1 or cell.name.lower() == 'top' or cell.name.lower() == 'EBeam_':
             log("  - top cell: %s" % cell.name)
 
             # check layout height
-            if cell.bbox().top < cell.bbox().bottom:
+            bbox = cell.bbox()
+            if bbox.top < bbox.bottom:
                 log(' - WARNING: empty layout. Skipping.')
                 break
                 
-            # Create sub-cell using the filename under course cell
-            subcell2 = layout.create_cell(os.path.basename(f)+"_"+filedate)
-            course_cells.append(subcell2)
-
-            
             # Clear extra layers
-            layers_keep2 = [layer_SEM] if course in layer_SEM_allow else []
-            for li in layout2.layer_infos():
-                if li.to_s() in layers_keep + layers_keep2:
-                    log('  - loading layer: %s' % li.to_s())
+            keep_set = layers_keep_SEM_set if course in layer_SEM_allow else layers_keep_set
+            for layer_index in layout2.layer_indexes():
+                li = layout2.get_info(layer_index)
+                if (li.layer, li.datatype) in keep_set:
+                    log('  - loading layer: %s' % li)
                 else:
-                    log('  - deleting layer: %s' % li.to_s())
-                    layer_index = layout2.find_layer(li)
+                    log('  - deleting layer: %s' % li)
                     layout2.delete_layer(layer_index)
                     
-            # Delete non-text geometries in the Text layer
+            # Delete non-text geometries in the Text layer, one pass per cell
+            # SiEPIC-Tools labels are moved to the sub-cell, when merging
+            texts_siepictools = []
             layer_index = layout2.find_layer(int(layer_text.split('/')[0]), int(layer_text.split('/')[1]))
             if type(layer_index) != type(None):
-                s = cell.begin_shapes_rec(layer_index)
-                shapes_to_delete = []
-                while not s.at_end():
-                    if s.shape().is_text():
-                        text = s.shape().text.string
+                for cell_index in [cell.cell_index()] + cell.called_cells():
+                    shapes = layout2.cell(cell_index).shapes(layer_index)
+                    if shapes.is_empty():
+                        continue
+                    shapes_keep = pya.Shapes()
+                    # non-text geometries are removed
+                    removed = any(True for _ in shapes.each(pya.Shapes.SAll & ~pya.Shapes.STexts))
+                    for s in shapes.each(pya.Shapes.STexts):
+                        text = s.text.string
                         if text.startswith('SiEPIC-Tools'):
                             if log_siepictools:
-                                log('  - %s' % s.shape() )
-                            s.shape().delete()
-                            subcell2.shapes(layerTextN).insert(pya.Text(text, 0, 0))
-                        elif text.startswith('opt_in'):
-                            log('  - measurement label: %s' % text )
-                    else:
-                        shapes_to_delete.append( s.shape() )
-                    s.next()
-                for s in shapes_to_delete:
-                    s.delete()
-
-            # bounding box of the cell
+                                log('  - %s' % s )
+                            texts_siepictools.append(text)
+                            removed = True
+                        else:
+                            if text.startswith('opt_in'):
+                                log('  - measurement label: %s' % text )
+                            shapes_keep.insert(s)
+                    # most cells only have labels to keep; rewrite only if something is removed.
+                    # (not by comparing sizes: text arrays count as one shape, but iterate per member)
+                    if removed:
+                        shapes.clear()
+                        shapes.insert(shapes_keep)
+
+            # bounding box of the cell, after removing the layers and shapes
             bbox = cell.bbox()
+            bleft, bbot = bbox.left, bbox.bottom
             log('  - bounding box: %s' % bbox.to_s() )
                             
-            # Create sub-cell under subcell cell, using user's cell name
-            subcell = layout.create_cell(cell.name)
-            t = Trans(Trans.R0, -bbox.left,-bbox.bottom)
-            subcell_inst = subcell2.insert(CellInstArray(subcell.cell_index(), t)) 
-            subcell_instances.append (subcell_inst)
-        
             # clip cells
-            cell2 = layout2.clip(cell.cell_index(), pya.Box(bbox.left,bbox.bottom,bbox.left+cell_Width,bbox.bottom+cell_Height))
+            cell2 = layout2.clip(cell.cell_index(), pya.Box(bleft,bbot,bleft+cell_Width,bbot+cell_Height))
             bbox2 = layout2.cell(cell2).bbox()
             if bbox != bbox2:
                 log('  - WARNING: Cell was clipped to maximum size of %s X %s' % (cell_Width, cell_Height) )
                 log('  - clipped bounding box: %s' % bbox2.to_s() )
 
-            # copy
-            subcell.copy_tree(layout2.cell(cell2))  
-            
-            log('  - Placed at position: %s, %s' % (x,y) )
-            
-            # add a pin so we can connect a waveguide from the laser tree  
-            from SiEPIC.utils.layout import make_pin
-            make_pin(subcell2, 'opt_laser', [0, int(student_laser_in_y)], wg_width, 'PinRec', 180, debug=False)
-                          
-            design_count += 1
-            cells_course.append (cell_course)
+            designs.append({'file': save_design(cell2),
+                            'cell_name': cell.name,
+                            'offset': (bleft, bbot),
+                            'texts': texts_siepictools})
+
+    layout2._destroy()
+
+    return {'file': f, 'filedate': filedate, 'course': course, 'log': messages, 'designs': designs}
+
+# Process the submissions in parallel, then merge them one at a time.
+# Workers are forked, only on Linux: on macOS forking after the system frameworks
+# are loaded is unsafe, and spawning would run this whole script again in each worker.
+# Inside the KLayout application, or on other platforms, process them sequentially.
+import sys
+import tempfile
+import multiprocessing
+from contextlib import nullcontext
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+use_pool = Python_Env == "Script" and sys.platform.startswith('linux')
+if use_pool:
+    log_file.flush()  # so that the forked workers do not inherit buffered lines
+
+# Origins for the layouts
+x,y = 2.5e6,cell_Height+cell_Gap_Height
+design_count = 0
+subcell_instances = []
+course_cells = []  # list of each of the student designs
+cells_course = []  # into which course cell the design should go into
+tmp_dir = tempfile.mkdtemp()
+try:
+    with (ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('fork'))
+          if use_pool else nullcontext()) as executor:
+        results = (executor.map if executor else map)(process_submission, range(len(files_in)), files_in, repeat(tmp_dir))
+        for result in results:
+            basefilename = os.path.basename(result['file'])
+            filedate = result['filedate']
+            course = result['course']
+            cell_course = course_cells_by_name[course]
+            for text in result['log']:
+                log(text)
+
+            for design in result['designs']:
+                # Load the processed layout, one at a time, non-editable
+                layout2 = pya.Layout(False)
+                layout2.read(design['file'])
+                os.remove(design['file'])
+                cell = layout2.top_cell()
+
+                if framework_file in basefilename:
+                    # Create sub-cell using the filename under top cell
+                    subcell2 = layout.create_cell(basefilename+"_"+filedate)
+                    t = Trans(Trans.M90, 0,0)
+                    top_cell.insert(CellInstArray(subcell2.cell_index(), t))
+                    # copy
+                    subcell2.copy_tree(cell) 
+                    layout2._destroy()
+                    continue
+
+                if basefilename == ubc_file:
+                    # Create sub-cell using the filename under top cell
+                    subcell2 = layout.create_cell(basefilename+"_"+filedate)
+                    t = Trans(Trans.R0, 8780000,8780000)      
+                    top_cell.insert(CellInstArray(subcell2.cell_index(), t))
+                    # copy
+                    subcell2.copy_tree(cell) 
+                    layout2._destroy()
+                    continue
+
+                # Create sub-cell using the filename under course cell
+                subcell2 = layout.create_cell(basefilename+"_"+filedate)
+                course_cells.append(subcell2)
+                for text in design['texts']:
+                    subcell2.shapes(layerTextN).insert(pya.Text(text, 0, 0))
+
+                # Create sub-cell under subcell cell, using user's cell name
+                subcell = layout.create_cell(design['cell_name'])
+                t = Trans(Trans.R0, -design['offset'][0],-design['offset'][1])
+                subcell_inst = subcell2.insert(CellInstArray(subcell.cell_index(), t)) 
+                subcell_instances.append (subcell_inst)
+
+                # copy
+                subcell.copy_tree(cell)  
+                layout2._destroy()
+        
+                log('  - Placed at position: %s, %s' % (x,y) )
+        
+                # add a pin so we can connect a waveguide from the laser tree  
+                from SiEPIC.utils.layout import make_pin
+                make_pin(subcell2, 'opt_laser', [0, int(student_laser_in_y)], wg_width, 'PinRec', 180, debug=False)
+                      
+                design_count += 1
+                cells_course.append (cell_course)
+finally:
+    shutil.rmtree(tmp_dir)
          
 
 # Enable libraries, to create waveguides, laser, etc
@@ -493,10 +579,16 @@ if power_monitor_index is not None:
     #course_cells.insert(0, power_monitor_cell)
     log("Popped power monitor cell")
     
-    # Create copies of power monitor for each laser circuit
+    # Create copies of power monitor for each laser circuit,
+    # rebuilding the list with the power monitor first in each group of designs
+    slots = tree_depth * tree_depth
+    chunk = slots - 1
+    new_cells = []
     for row in range(n_lasers):
-        course_cells.insert(row * tree_depth**2, power_monitor_cell)
-        log("Created power monitor copy for laser circuit %d at position %d" % (row, row * tree_depth**2))
+        new_cells.append(power_monitor_cell)
+        new_cells.extend(course_cells[row*chunk:(row+1)*chunk])
+        log("Created power monitor copy for laser circuit %d at position %d" % (row, row * slots))
+    course_cells = new_cells + course_cells[n_lasers*chunk:]
 else:
     log("WARNING: No power monitor cell found in course_cells")
 
@@ -552,14 +644,13 @@ if not cell_pad:
 #    raise Exception ('Cannot load Waveguide Straight cell; please check the script carefully.')
 
 # Waveguide type:
-waveguides = ly.load_Waveguide_types()
-waveguide1 = [w for w in waveguides if w['name']==waveguide_type]
-if type(waveguide1) == type([]) and len(waveguide1)>0:
-    waveguide = waveguide1[0]
-else:
-    waveguide = waveguides[0]
+waveguides_by_name = {}
+for w in ly.load_Waveguide_types():
+    waveguides_by_name.setdefault(w['name'], w)  # first one wins
+waveguide = waveguides_by_name.get(waveguide_type)
+if not waveguide:
     print('error: waveguide type not found in PDK waveguides')
-    raise Exception('error: waveguide type (%s) not found in PDK waveguides: \n%s' % (waveguide_type, [w['name'] for w in waveguides]))
+    raise Exception('error: waveguide type (%s) not found in PDK waveguides: \n%s' % (waveguide_type, list(waveguides_by_name)))
 radius_um = float(waveguide['radius'])
 print('*** radius_um: %s' % radius_um)
 radius = to_itype(waveguide['radius'],ly.dbu)
@@ -567,9 +658,30 @@ radius = to_itype(waveguide['radius'],ly.dbu)
 
 # laser_height = cell_laser.bbox().height()
 
+# Splitter tree: build it once, and make a copy for each of the other laser circuits.
+# Each laser circuit needs its own tree cell, since waveguides can only be routed
+# to instances whose cell is placed once, and terminators are added to the tree.
+def copy_splitter_tree(inst_tree_in, inst_tree_out, cell_tree):
+    '''Copy the splitter tree cell, and find the input and output instances in the copy'''
+    cell_copy = cell_tree.dup()
+    key = lambda inst: (inst.cell_index, inst.trans.to_s())
+    insts = {key(inst): inst for inst in cell_copy.each_inst()}
+    return insts[key(inst_tree_in)], [insts[key(inst)] for inst in inst_tree_out], cell_copy
+
+from SiEPIC.utils.layout import y_splitter_tree
+splitter_trees = [y_splitter_tree(top_cell, tree_depth=tree_depth, y_splitter_cell=cell_y, library="EBeam-SiN", wg_type=waveguide_type, draw_waveguides=True)]
+for row in range(1, n_lasers):
+    splitter_trees.append(copy_splitter_tree(*splitter_trees[0]))
+
+# Student design array and routing, constants for the loops
+cell_pitch_x = radius + cell_Width + waveguide_pitch/dbu * cells_rows_per_laser
+cell_pitch_y = cell_Height + cell_Gap_Height
+student_laser_in_y_um = student_laser_in_y*dbu
+
 # Laser circuits:
 inst_tree_out_all = []
 laser_circuit_cells = []
+m2_lyr = ly.layer(ly.TECHNOLOGY['M2_router'])
 
 for row in range(0, n_lasers):
     
@@ -578,46 +690,41 @@ for row in range(0, n_lasers):
     laser_circuit_cells.append(laser_circuit_cell)
     
     # laser, place at absolute position in the laser circuit sub-cell
-    t = pya.Trans.from_s('r0 %s,%s' % (int(laser_x), int(laser_y)) )
+    t = pya.Trans(int(laser_x), int(laser_y))
     inst_laser = laser_circuit_cell.insert(pya.CellInstArray(cell_laser.cell_index(), t))
     
     # heater, attach to the laser, then move it slight away from the laser
     inst_heater =connect_cell(inst_laser, 'opt1', cell_heater, 'opt1')
-    inst_heater.transform(pya.Trans(laser_heater_distance, 0))
+    inst_heater.transform(pya.Trans(int(laser_heater_distance), 0))
     connect_pins_with_waveguide(inst_laser, 'opt1', inst_heater, 'opt1', waveguide_type=waveguide_type, turtle_A=[radius_um,90]) #turtle_B=[10,-90, 100, 90])
 
     # Bond pad for phase shifter heater
-    t = pya.Trans.from_s('r0 %s,%s' % (int(laser_x), inst_laser.bbox().top + laser_pad_distance+ cell_pad.bbox().height()) )
+    pad_y = inst_laser.bbox().top + laser_pad_distance+ cell_pad.bbox().height()
+    t = pya.Trans(int(laser_x), int(pad_y))
     inst_pad1 = laser_circuit_cell.insert(pya.CellInstArray(cell_pad.cell_index(), t))
-    t = pya.Trans.from_s('r0 %s,%s' % (int(laser_x), inst_laser.bbox().top + laser_pad_distance+ cell_pad.bbox().height() + pad_pitch) )
+    t = pya.Trans(int(laser_x), int(pad_y + pad_pitch))
     inst_pad2 = laser_circuit_cell.insert(pya.CellInstArray(cell_pad.cell_index(), t))
     
-    # Metal routing
-    pts = [
-        inst_pad1.find_pin('m_pin_right').center,
-        [inst_heater.find_pin('elec1').center.x,
-        inst_pad1.find_pin('m_pin_right').center.y],
-        inst_heater.find_pin('elec1').center
-        ]
-    path = pya.Path(pts, 20e3)
-    s = laser_circuit_cell.shapes(ly.layer(ly.TECHNOLOGY['M2_router'])).insert(path)
-    pts = [
-        inst_pad2.find_pin('m_pin_right').center,
-        [inst_heater.find_pin('elec2').center.x,
-        inst_pad2.find_pin('m_pin_right').center.y],
-        inst_heater.find_pin('elec2').center
-        ]
-    path = pya.Path(pts, 20e3)
-    s = laser_circuit_cell.shapes(ly.layer(ly.TECHNOLOGY['M2_router'])).insert(path)
+    # Metal routing, from each bond pad to the heater
+    m2_shapes = laser_circuit_cell.shapes(m2_lyr)
+    for inst_pad, heater_pin_name in [(inst_pad1, 'elec1'), (inst_pad2, 'elec2')]:
+        pad_pin = inst_pad.find_pin('m_pin_right').center
+        heater_pin = inst_heater.find_pin(heater_pin_name).center
+        pts = [
+            pad_pin,
+            [heater_pin.x,
+            pad_pin.y],
+            heater_pin
+            ]
+        m2_shapes.insert(pya.Path(pts, 20e3))
         
     
     # splitter tree
-    from SiEPIC.utils.layout import y_splitter_tree
     if tree_depth == 4:
         n_x_gc_arrays = 6
         n_y_gc_arrays = 1
         x_tree_offset = 0
-        inst_tree_in, inst_tree_out, cell_tree = y_splitter_tree(laser_circuit_cell, tree_depth=tree_depth, y_splitter_cell=cell_y, library="EBeam-SiN", wg_type=waveguide_type, draw_waveguides=True)
+        inst_tree_in, inst_tree_out, cell_tree = splitter_trees[row]
         ytree_x = inst_heater.bbox().right + x_tree_offset
         ytree_y = inst_heater.pinPoint('opt2').y # - cell_tree.bbox().height()/2
         t = Trans(Trans.R0, ytree_x, ytree_y)
@@ -641,21 +748,24 @@ for row in range(0, n_lasers):
     cell_row, cell_column = 0, 0
     for d in range(row*tree_depth**2, min(design_count,(row+1)*tree_depth**2)):
         # Instantiate the course student cell in the laser circuit cell
-        position_y = cell_row * (cell_Height + cell_Gap_Height)
-        position_x = cell_column * (radius + cell_Width + waveguide_pitch/dbu * cells_rows_per_laser)
+        position_y = cell_row * cell_pitch_y
+        position_x = cell_column * cell_pitch_x
         t = Trans(Trans.R0, position_x0 + position_x, position_y0 + position_y)
         inst_student = laser_circuit_cell.insert(CellInstArray(course_cells[d].cell_index(), t))    
+        # splitter tree output port for this design
+        inst_tree, pin_tree = inst_tree_out_all[int(d/2)], 'opt%s'%(2+(d+1)%2)
+        rows_above = cells_rows_per_laser-cell_row-1
         connect_pins_with_waveguide(
-            inst_tree_out_all[int(d/2)], 'opt%s'%(2+(d+1)%2), 
+            inst_tree, pin_tree, 
             inst_student, 'opt_laser', 
             waveguide_type=waveguide_type_routing, 
             turtle_B = [ # from the student
-                (cells_rows_per_laser-cell_row-1)*waveguide_pitch+radius_um,-90, # left away from student design
-                student_laser_in_y*ly.dbu+(cells_rows_per_laser-cell_row-1)*(cell_Height + cell_Gap_Height)*dbu + (cell_row + cell_column*cells_rows_per_laser)*waveguide_pitch,90, # up the column to the top
+                rows_above*waveguide_pitch+radius_um,-90, # left away from student design
+                student_laser_in_y_um+rows_above*cell_pitch_y*dbu + (cell_row + cell_column*cells_rows_per_laser)*waveguide_pitch,90, # up the column to the top
                 100,90, # left towards the laser
             ],
             turtle_A = [ # from the laser
-                radius_um+((cells_columns_per_laser-cell_column-1)*cells_rows_per_laser + (cells_rows_per_laser-cell_row-1))*waveguide_pitch, 90,
+                radius_um+((cells_columns_per_laser-cell_column-1)*cells_rows_per_laser + rows_above)*waveguide_pitch, 90,
                 radius_um,-90,
             ],
             verbose=False) 
@@ -675,8 +785,8 @@ for row in range(0, n_lasers):
     laser_y += laser_dy
 
 # Insert all laser circuit cells into the top cell
+t = Trans(Trans.R0, 0, 0)
 for i, laser_circuit_cell in enumerate(laser_circuit_cells):
-    t = Trans(Trans.R0, 0, 0)
     top_cell.insert(CellInstArray(laser_circuit_cell.cell_index(), t))
 
   
@@ -703,6 +813,7 @@ if Python_Env == "Script":
 # Create an image of the layout
 top_cell.image(os.path.join(path,filename+'.png'))
 
+log_file.flush()
 print('Completed %s designs' % design_count)
 
 